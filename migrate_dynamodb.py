@@ -1,238 +1,869 @@
-import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from botocore.exceptions import ClientError
+from botocore.config import Config
 from boto3 import client, Session
-import backoff
-import sys
-import copy
+from itertools import chain, islice
+from typing import Collection, FrozenSet
+import functools
+import threading
+import logging
+import random
+import queue
+import math
+import time
+
+log = logging.getLogger(__name__)
+
+# The amount of table data covered by every parallel scan segment, and the maximum number of segments of a table.
+# DynamoDB accepts up to 1,000,000 segments, larger tables get bigger segments instead of more of them.
+SEGMENT_SIZE = 1024 * 1024
+MAX_SEGMENTS = 1000
+
+# The maximum number of items BatchWriteItem accepts in a single request. 25 items of at most 400KB always fit in the
+# 16MB request limit, so batches are not sized by bytes.
+BATCH_SIZE = 25
+
+# The maximum number of items and bytes TransactWriteItems accepts in a single request.
+TRANSACTION_SIZE = 100
+TRANSACTION_BYTES = 4 * 1024 * 1024
+
+# The number of items requested by every scan call.
+PAGE_SIZE = 1000
+
+# The ways migrate_dynamo_data treats items that already exist in the destination.
+MODES = ('merge', 'overwrite', 'if_absent')
+
+# The requests migrate_dynamo_data writes items with.
+BATCH_MODES = ('batch', 'transact')
+
+# The tables migrate_dynamo_data skips unless told otherwise.
+EXCLUDE: FrozenSet[str] = frozenset({'Performance', 'PerformanceMetrics', 'ProductionPipelineErrors'})
+
+# The number of tables created concurrently, CreateTable requests are rate limited per account.
+SCHEMA_WORKERS = 10
+
+# The maximum number of batches that are written concurrently to a single table, and per writer thread to all tables.
+MAX_WRITER_CONCURRENCY = 16
 
+# The number of attempts of a write that make no progress before giving up, and the bounds in seconds of the backoff
+# in between.
+MAX_WRITE_ATTEMPTS = 10
+BASE_BACKOFF = 0.05
+MAX_BACKOFF = 5
 
-def copy_dynamo_schema(src_session: Session, dst_session: Session, tables: list = ()) -> None:
+# The reasons a transaction may be cancelled for that are retried with a backoff.
+RETRYABLE_CANCELLATIONS = frozenset({'ThrottlingError', 'ProvisionedThroughputExceeded', 'TransactionConflict'})
+
+# The share of the provisioned write capacity of a destination table that a migration may consume.
+WRITE_CAPACITY_SHARE = 0.9
+
+# Shared by every client, so that connections are pooled and kept alive across tables and threads.
+CLIENT_CONFIG = Config(max_pool_connections=128, tcp_keepalive=True,
+                       retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+
+@functools.lru_cache(maxsize=None)
+def _client(session: Session) -> client:
+    """
+    Returns the DynamoDB client of a session, creating it on first use.
+    :param session: The AWS Session of the targeted AWS profile/region
+    :return: A DynamoDB client
     """
-    Reads the DynamoDB in source region and creates the same tables in destination region.
+    return session.client('dynamodb', config=CLIENT_CONFIG)
+
+
+def _describe_table(session: Session, table: str) -> dict:
+    """
+    Returns the description of a table. It is read once per table by every call that needs it, and never kept across
+    calls, so that migrations always see the current state of the tables.
+    :param session: The AWS Session of the targeted AWS profile/region
+    :param table: The table name
+    :return: The Table of the describe_table response
+    """
+    return _client(session).describe_table(TableName=table)['Table']
+
+
+def copy_dynamo_schema(src_session: Session, dst_session: Session, tables: list = (),
+                       warm_write_units: int = None) -> None:
+    """
+    Reads the DynamoDB in source region and creates the same tables in destination region. The billing mode of
+    every table is preserved, on-demand tables are created without provisioned throughput. The tables are created in
+    parallel and the function returns once all of them are active, so their data can be migrated right away.
 
     :param src_session: The aws session object of the source profile/region.
     :param dst_session: The aws session object of the destination profile/region.
     :param tables: A list of the tables to be copied. If empty all tables will be created.
+    :param warm_write_units: If set, the tables are created pre-warmed to sustain this many writes per second, so that
+    the bulk load of a migration is not throttled while a new table ramps up.
     :return: None
     """
 
-    d_src_client = src_session.client('dynamodb')
+    d_src_client = _client(src_session)
 
     if not tables:
         tables = d_src_client.list_tables()['TableNames']
 
-    for name in tables:
-        d_src_resource = src_session.resource('dynamodb')
-        table = d_src_resource.Table(name)
+    waiter = _client(dst_session).get_waiter('table_exists')
+
+    with ThreadPoolExecutor(max_workers=SCHEMA_WORKERS) as executor:
+        created = list(executor.map(lambda name: _create_table(name, src_session, dst_session, warm_write_units),
+                                    tables))
+        list(executor.map(lambda name: waiter.wait(TableName=name, WaiterConfig={'Delay': 2, 'MaxAttempts': 60}),
+                          created))
+
+    log.info(f'All {len(created)} tables are active in {dst_session.region_name}')
 
-        d_dest_resource = dst_session.resource('dynamodb')
-        provisioned_throughput = table.provisioned_throughput
 
-        if 'NumberOfDecreasesToday' in provisioned_throughput.keys():
-            del provisioned_throughput['NumberOfDecreasesToday']
+def _create_table(name: str, src_session: Session, dst_session: Session, warm_write_units: int = None) -> str:
+    table = _describe_table(src_session, name)
 
-        params = {
-            'TableName': name,
-            'KeySchema': table.key_schema,
-            'AttributeDefinitions': table.attribute_definitions,
-            'ProvisionedThroughput': provisioned_throughput
-        }
+    # Tables that were never switched to on-demand have no BillingModeSummary.
+    on_demand = table.get('BillingModeSummary', {}).get('BillingMode') == 'PAY_PER_REQUEST'
+
+    params = {
+        'TableName': name,
+        'KeySchema': table['KeySchema'],
+        'AttributeDefinitions': table['AttributeDefinitions']
+    }
+
+    if on_demand:
+        params['BillingMode'] = 'PAY_PER_REQUEST'
+    else:
+        params['ProvisionedThroughput'] = _throughput_params(table['ProvisionedThroughput'])
 
-        if table.global_secondary_indexes:
-            gsi = table.global_secondary_indexes
-            gsi_copy = copy.deepcopy(gsi)
+    if table.get('GlobalSecondaryIndexes'):
+        params['GlobalSecondaryIndexes'] = []
+        for gsi in table['GlobalSecondaryIndexes']:
+            index = {'IndexName': gsi['IndexName'], 'KeySchema': gsi['KeySchema'], 'Projection': gsi['Projection']}
+            if not on_demand:
+                index['ProvisionedThroughput'] = _throughput_params(gsi['ProvisionedThroughput'])
+            params['GlobalSecondaryIndexes'].append(index)
 
-            for item in gsi:
-                for key in item.keys():
-                    if key not in ["IndexName", "KeySchema", "Projection", "ProvisionedThroughput"]:
-                        del gsi_copy[gsi.index(item)][key]
+    if warm_write_units:
+        params['WarmThroughput'] = {'WriteUnitsPerSecond': warm_write_units}
 
-                if 'NumberOfDecreasesToday' in gsi_copy[gsi.index(item)]['ProvisionedThroughput'].keys():
-                    del gsi_copy[gsi.index(item)]['ProvisionedThroughput']['NumberOfDecreasesToday']
-            params['GlobalSecondaryIndexes'] = gsi_copy
+    _client(dst_session).create_table(**params)
+    log.info(f'Created table {name}')
+    return name
 
-        d_dest_resource.create_table(**params)
-        print(f'Created table {name}')
 
+def _throughput_params(throughput: dict) -> dict:
+    # Described throughputs also carry their capacity change history, which create_table does not accept.
+    return {key: throughput[key] for key in ('ReadCapacityUnits', 'WriteCapacityUnits')}
 
-def migrate_dynamo_data(src_session: Session, dst_session: Session, tables: list = ()) -> None:
+
+def migrate_dynamo_data(src_session: Session, dst_session: Session, tables: list = (), workers: int = 16,
+                        writers: int = 8, mode: str = 'merge', batch_mode: str = 'batch',
+                        exclude: Collection[str] = EXCLUDE) -> None:
     """
     The function copies data from tables in source_region DynamoDB to same tables in destination_region DynamoDB.
     The tables in destination must exist and have the same schema with the source.
 
+    Every table is split into parallel scan segments (one per MB of table size) that are processed by a bounded pool
+    of scanner threads, while a separate pool of writer threads consumes the pages that need to be written. The
+    batches of all tables are written on one shared pool, where every table may use as many threads as the write
+    capacity of its destination table allows.
+
     :param src_session: The aws session object of the source profile/region.
     :param dst_session: The aws session object of the destination profile/region.
     :param tables: A list of the tables to be copied. If empty all tables will be copied.
+    :param workers: The maximum number of segments that are scanned concurrently.
+    :param writers: The number of threads that write the scanned pages to the destination.
+    :param mode: How existing destination items are treated. 'merge' scans the destination and writes only the items
+    that are missing, 'overwrite' writes every item without reading the destination and 'if_absent' writes every item
+    with a conditional put that leaves existing items untouched.
+    :param batch_mode: 'batch' writes the items with BatchWriteItem, 25 at a time. 'transact' writes them with
+    TransactWriteItems, 100 at a time, which in 'if_absent' mode replaces a conditional put per item. Transactional
+    writes consume twice the write capacity.
+    :param exclude: The names of the tables that are never copied.
     :return: None
     """
 
-    d_src = src_session.client('dynamodb')
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}, got {mode!r}")
+    if batch_mode not in BATCH_MODES:
+        raise ValueError(f"batch_mode must be one of {', '.join(BATCH_MODES)}, got {batch_mode!r}")
+
+    d_src = _client(src_session)
 
     if not tables:
         tables = d_src.list_tables()['TableNames']
 
-    exclude_list = ['Performance', 'PerformanceMetrics', 'ProductionPipelineErrors']
-    tables = [item for item in tables if item not in exclude_list]
+    exclude = frozenset(exclude)
+    tables = [item for item in tables if item not in exclude]
+
+    write_queue = queue.Queue(maxsize=writers * 4)
+    # Set on the first failure, so that scanners and writers stop instead of finishing the rest of the migration.
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=writers * MAX_WRITER_CONCURRENCY) as batch_pool, \
+            ThreadPoolExecutor(max_workers=writers) as writer_pool:
+        writer_futures = [writer_pool.submit(write_worker, write_queue, stop) for _ in range(writers)]
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as scanner_pool:
+                futures = []
+                try:
+                    for table in tables:
+                        try:
+                            dst_description = _describe_table(dst_session, table)
+                        except ClientError as e:
+                            if not _is_not_found(e):
+                                raise
+                            log.warning(f"{table} was not found in destination {dst_session.region_name}")
+                            continue
+
+                        description = _describe_table(src_session, table)
+                        key_attributes = [key['AttributeName'] for key in description['KeySchema']]
+                        total_segments = get_total_segments(description)
+                        table_pool = TablePool(batch_pool, get_writer_concurrency(dst_description))
+                        limiter = get_write_limiter(dst_description)
+                        for segment in range(total_segments):
+                            futures.append(scanner_pool.submit(copy_table_thread, table, src_session, dst_session,
+                                                               segment, total_segments, write_queue, key_attributes,
+                                                               table_pool, mode, limiter, batch_mode, stop))
+
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    stop.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            for _ in writer_futures:
+                write_queue.put(None)
+
+        for future in writer_futures:
+            future.result()
+
+
+def _is_not_found(error: ClientError) -> bool:
+    return error.response['Error']['Code'] == 'ResourceNotFoundException'
+
+
+def get_total_segments(description: dict) -> int:
+    """
+    Calculates the number of parallel scan segments of a table, one segment for every MB of data up to MAX_SEGMENTS.
+    :param description: The table description as returned by describe_table
+    :return: The number of segments
+    """
+
+    return min(MAX_SEGMENTS, max(1, math.ceil(description.get('TableSizeBytes', 0) / SEGMENT_SIZE)))
+
+
+def scan_segment(table: str, d_client: client, segment: int = 0, total_segments: int = 1,
+                 attributes: list = None):
+    """
+    A generator that scans a segment of a table and yields the scan responses page by page.
+    :param table: The table name to be scanned
+    :param d_client: A DynamoDB client of the profile/region the table lives in
+    :param segment: The segment to be scanned
+    :param total_segments: The total number of segments the table is split into
+    :param attributes: The names of the attributes to be returned. If None all attributes are returned.
+    :return: A generator of scan responses
+    """
+
+    params = {'TableName': table, 'Segment': segment, 'TotalSegments': total_segments}
 
-    for table in tables:
-        t = threading.Thread(target=copy_table_thread, args=(table, src_session, dst_session))
-        t.start()
+    if attributes:
+        names = {f'#a{i}': name for i, name in enumerate(attributes)}
+        params['ProjectionExpression'] = ','.join(names)
+        params['ExpressionAttributeNames'] = names
 
+    paginator = d_client.get_paginator('scan')
+    yield from paginator.paginate(PaginationConfig={'PageSize': PAGE_SIZE}, **params)
 
-def copy_table_thread(table: str, src_session: Session, dst_session: Session) -> None:
 
+def write_worker(write_queue: queue.Queue, stop: threading.Event = None) -> None:
     """
-    Spawns a thread that copies data from src_session DynamoDB table to the destination the same table name in
+    Consumes pages from the write queue and writes them to the destination until a None sentinel is received.
+    :param write_queue: A queue of tuples holding a write function followed by its arguments
+    :param stop: An event that is set on the first failure of the migration, after which pages are no longer written.
+    :return: None
+    """
+
+    error = None
+    stop = stop or threading.Event()
+
+    while True:
+        work = write_queue.get()
+        if work is None:
+            break
+
+        # After a failure the queue is only drained, so that the scanners never block on a full queue.
+        if stop.is_set():
+            continue
+
+        try:
+            write_function, *args = work
+            write_function(*args)
+        except Exception as e:
+            error = error or e
+            stop.set()
+
+    if error:
+        raise error
+
+
+def get_items_to_write(src_items: list, dst_items: list, key_attributes: list) -> list:
+    """
+    Finds the source items whose primary key is missing from the destination. Only the key attributes of the
+    destination items are needed, so they can be scanned with a key-only projection.
+    :param src_items: The items scanned from the source
+    :param dst_items: The items scanned from the destination
+    :param key_attributes: The names of the primary key attributes of the table
+    :return: A list of the items to be written
+    """
+
+    dst_keys = {_item_key(item, key_attributes) for item in dst_items}
+    return [item for item in src_items if _item_key(item, key_attributes) not in dst_keys]
+
+
+def _item_key(item: dict, key_attributes: list) -> tuple:
+    # Key attributes are scalars, e.g. {'S': 'value'}, so every one maps to a hashable (type, value) pair.
+    return tuple(next(iter(item[name].items())) for name in key_attributes)
+
+
+def copy_table_thread(table: str, src_session: Session, dst_session: Session, segment: int = 0,
+                      total_segments: int = 1, write_queue: queue.Queue = None,
+                      key_attributes: list = None, executor: 'TablePool' = None, mode: str = 'merge',
+                      limiter: 'TokenBucket' = None, batch_mode: str = 'batch',
+                      stop: threading.Event = None) -> None:
+
+    """
+    Copies data from a segment of a src_session DynamoDB table to the destination the same table name in
     dst_session.
     :param table: The name of the table to be copied
     :param src_session: The AWS source Session
     :param dst_session: The AWS destination Session
+    :param segment: The segment of the table to be copied
+    :param total_segments: The total number of segments the table is split into
+    :param write_queue: A queue that the pages to be written are sent to. If None pages are written directly.
+    :param key_attributes: The names of the primary key attributes of the table. If None they are described.
+    :param executor: The pool that the batches of the table are written on. If None they are written one by one.
+    :param mode: One of 'merge', 'overwrite' or 'if_absent', see migrate_dynamo_data.
+    :param limiter: A TokenBucket of write capacity units of the destination table. If None writes are not limited.
+    :param batch_mode: One of 'batch' or 'transact', see migrate_dynamo_data.
+    :param stop: An event that is set on the first failure of the migration, after which no more pages are copied.
     :return: None
     """
 
-    print(f"Scanning table {table} in source {src_session.region_name}\r")
-    d_src = src_session.client('dynamodb')
-    d_dst = dst_session.client('dynamodb')
+    def write(items: list, page: int) -> None:
+        partition_key = key_attributes[0] if mode == 'if_absent' else None
 
-    source_response = d_src.scan(TableName=table)
+        if batch_mode == 'transact':
+            work = (write_transactions, items, table, d_dst, page, partition_key, executor, limiter)
+        elif mode == 'if_absent':
+            work = (put_items_if_absent, items, table, d_dst, page, partition_key, executor, limiter)
+        else:
+            work = (write_items, items, table, d_dst, page, executor, limiter)
 
-    try:
-        print(f"Scanning table {table} in destination {dst_session.region_name}\r")
-        dst_response = d_dst.scan(TableName=table)
+        if write_queue is None:
+            write_function, *args = work
+            write_function(*args)
+        else:
+            write_queue.put(work)
+
+    log.info(f"Scanning table {table} segment {segment + 1}/{total_segments} in source {src_session.region_name}")
+    d_src = _client(src_session)
+    d_dst = _client(dst_session)
+
+    if key_attributes is None:
+        key_schema = _describe_table(src_session, table)['KeySchema']
+        key_attributes = [key['AttributeName'] for key in key_schema]
 
-    except ClientError:
-        print(f"{table} was not found in destination {dst_session.region_name}")
-        return
+    source_pages = scan_segment(table, d_src, segment, total_segments)
+    dst_pages = None
 
-    src_items = source_response['Items']
-    dst_items = dst_response['Items']
+    if mode == 'merge':
+        log.info(f"Scanning table {table} segment {segment + 1}/{total_segments} in destination "
+                 f"{dst_session.region_name}")
+        dst_pages = scan_segment(table, d_dst, segment, total_segments, key_attributes)
 
-    count = 1
+    # The counter holds the number of the pages returned from scan function until all items are returned.
+    for count, source_response in enumerate(source_pages, 1):
+        if stop is not None and stop.is_set():
+            return
+
+        items_to_write = source_response['Items']
+
+        if dst_pages is not None:
+            try:
+                dst_response = next(dst_pages, {'Items': []})
+            except ClientError as e:
+                # Only a table that is missing from the start is skipped, any other failure must fail the copy.
+                if count > 1 or not _is_not_found(e):
+                    raise
+                log.warning(f"{table} was not found in destination {dst_session.region_name}")
+                return
+
+            items_to_write = get_items_to_write(items_to_write, dst_response['Items'], key_attributes)
+
+            # Once the pages diverge they are no longer aligned, so the destination is not scanned anymore and the
+            # rest of the source pages are written as they are.
+            if items_to_write or source_response.get('LastEvaluatedKey') != dst_response.get('LastEvaluatedKey'):
+                dst_pages = None
+            else:
+                log.debug(f'Page {count} for Table {table} is identical to destination Table')
 
-    if src_items != dst_items:
-        items_to_write = [item for item in src_items if item not in dst_items]
         if items_to_write:
-            write_items(items_to_write, table, d_dst, count)
+            write(items_to_write, count)
+
+
+def write_items(items_to_write: list, table: str, d_dst: client, page: int, executor: 'TablePool' = None,
+                limiter: 'TokenBucket' = None) -> None:
+    """
+    Function that copies items in batches to a specified table. The batches are written concurrently on executor.
+    :param items_to_write: A list containing the items to be copied
+    :param table: The table name that items will be copied into
+    :param d_dst: A DynamoDB client of the destination
+    :param page: A specified page number to copied.
+    :param executor: The pool that the batches are written on. If None they are written one by one.
+    :param limiter: A TokenBucket of write capacity units that every batch is paid from. If None writes are not limited.
+    :return:
+    """
+
+    if items_to_write:
+        # The put requests are wrapped once, so the batches hold ready to send RequestItems lists.
+        prepared_batches = list(chunked(({'PutRequest': {'Item': item}} for item in items_to_write), BATCH_SIZE))
+        total_number_of_batches = len(prepared_batches)
+
+        error = None
+
+        with _table_pool(executor) as executor:
+            futures = {executor.submit(write_records, d_dst, {table: batch}, limiter): count
+                       for count, batch in enumerate(prepared_batches, 1)}
+
+            for future in as_completed(futures):
+                count = futures[future]
+                try:
+                    future.result()
+                    log.debug(f'Page {page} Batch {count}/{total_number_of_batches} for Table {table} '
+                              f'copied successfully!')
+                except Exception as e:
+                    log.error(f'Page {page} Batch {count}/{total_number_of_batches} for Table {table} '
+                              f'failed to copy!: {e}')
+                    error = error or e
+
+        # The rest of the batches of the page are still written, then the first failure fails the page.
+        if error:
+            raise error
+
+        log.info(f'Page {page} for Table {table} copied')
+    else:
+        log.info('Table {} is empty!'.format(table))
+
+
+def put_items_if_absent(items_to_write: list, table: str, d_dst: client, page: int, partition_key: str,
+                        executor: 'TablePool' = None, limiter: 'TokenBucket' = None) -> None:
+    """
+    Function that copies items to a specified table with conditional puts, so that items that already exist in the
+    destination are left untouched. The items are written concurrently on executor.
+    :param items_to_write: A list containing the items to be copied
+    :param table: The table name that items will be copied into
+    :param d_dst: A DynamoDB client of the destination
+    :param page: A specified page number to copied.
+    :param partition_key: The name of the partition key attribute of the table
+    :param executor: The pool that the items are written on. If None they are written one by one.
+    :param limiter: A TokenBucket of write capacity units that every put is paid from. If None puts are not limited.
+    :return:
+    """
+
+    with _table_pool(executor) as executor:
+        written = sum(executor.map(lambda item: _put_if_absent(d_dst, table, item, partition_key, limiter),
+                                   items_to_write))
+
+    log.info(f'Page {page} for Table {table}: {written} items copied, '
+             f'{len(items_to_write) - written} already existed')
+
+
+def _put_if_absent(d_dst: client, table: str, item: dict, partition_key: str, limiter: 'TokenBucket') -> bool:
+    if limiter:
+        limiter.acquire(_write_units(item))
 
     try:
-        src_key = source_response['LastEvaluatedKey']
-        dst_key = dst_response['LastEvaluatedKey']
-    except KeyError:
-        src_key = "1"
-        dst_key = "2"
-
-    while src_key == dst_key:
-        sys.stdout.flush()
-        sys.stdout.write(f'\rPage {count} for Table {table} is identical to destination Table')
-        source_response = d_src.scan(TableName=table, ExclusiveStartKey=src_key)
-        dst_response = d_dst.scan(TableName=table, ExclusiveStartKey=dst_key)
+        d_dst.put_item(TableName=table, Item=item, ConditionExpression='attribute_not_exists(#pk)',
+                       ExpressionAttributeNames={'#pk': partition_key})
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
 
+def _table_pool(executor: 'TablePool'):
+    # A shared pool must outlive the page that is written on it, a pool created for a single page must not.
+    return nullcontext(executor) if executor else ThreadPoolExecutor(max_workers=1)
+
+
+class TablePool:
+    """
+    Submits the writes of a single table to a pool shared by all tables, keeping at most concurrency of them in
+    flight. Submitting blocks until one of the table's writes finishes, so the shared pool stays bounded no matter
+    how many tables are written.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, concurrency: int):
+        """
+        :param executor: The pool shared by all tables
+        :param concurrency: The maximum number of writes of the table that run at the same time
+        """
+        self.executor = executor
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def submit(self, function, *args) -> Future:
+        """
+        Schedules function(*args) on the shared pool once the table has a free slot.
+        :return: The Future of the call
+        """
+
+        self.slots.acquire()
         try:
-            src_key = source_response['LastEvaluatedKey']
-            dst_key = dst_response['LastEvaluatedKey']
-            count += 1
-        except KeyError:
-            src_items = source_response['Items']
-            dst_items = dst_response['Items']
-            break
+            future = self.executor.submit(function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
 
-    if src_items != dst_items:
-        items_to_write = [item for item in src_items if item not in dst_items]
-        if items_to_write:
-            write_items(items_to_write, table, d_dst, count)
+    def map(self, function, iterable):
+        """
+        Like ThreadPoolExecutor.map, every element is submitted through submit.
+        :return: A generator of the results in the order of iterable
+        """
 
-    while 'LastEvaluatedKey' in source_response:
-        key = source_response['LastEvaluatedKey']
-        source_response = d_src.scan(TableName=table, ExclusiveStartKey=key)
-        items_to_write = source_response['Items']
-        write_items(items_to_write, table, d_dst, count)
-        # The following counter holds the number of the pages returned from scan function until all items are returned.
-        count += 1
+        futures = [self.submit(function, element) for element in iterable]
+        return (future.result() for future in futures)
 
 
-def write_items(items_to_write: list, table: str, d_dst: client, page: int) -> None:
+def get_writer_concurrency(description: dict) -> int:
     """
-    Function that copies items in batches to a specified table.
+    Calculates how many batches may be written concurrently to a table, one writer for every 50 provisioned WCU.
+    On-demand tables have no provisioned capacity and get the maximum concurrency.
+    :param description: The table description as returned by describe_table
+    :return: The number of concurrent batch writes
+    """
+
+    write_capacity = description.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+    if not write_capacity:
+        return MAX_WRITER_CONCURRENCY
+    return min(MAX_WRITER_CONCURRENCY, max(1, write_capacity // 50))
+
+
+def chunked(iterable, size: int):
+    """
+    Lazily splits an iterable into lists of at most size elements.
+    :param iterable: The iterable to be split
+    :param size: The maximum number of elements of every chunk
+    :return: An iterator of lists
+    """
+
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def chunked_by_size(iterable, size: int, max_bytes: int, element_size):
+    """
+    Lazily splits an iterable into lists of at most size elements and at most max_bytes bytes. An element larger than
+    max_bytes gets a list of its own.
+    :param iterable: The iterable to be split
+    :param size: The maximum number of elements of every chunk
+    :param max_bytes: The maximum total size of the elements of every chunk
+    :param element_size: A function that returns the size of an element in bytes
+    :return: A generator of lists
+    """
+
+    chunk = []
+    chunk_bytes = 0
+
+    for element in iterable:
+        element_bytes = element_size(element)
+
+        if chunk and (len(chunk) == size or chunk_bytes + element_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(element)
+        chunk_bytes += element_bytes
+
+    if chunk:
+        yield chunk
+
+
+def write_transactions(items_to_write: list, table: str, d_dst: client, page: int, partition_key: str = None,
+                       executor: 'TablePool' = None, limiter: 'TokenBucket' = None) -> None:
+    """
+    Function that copies items to a specified table with TransactWriteItems, up to 100 items per request. The
+    transactions are written concurrently on executor.
     :param items_to_write: A list containing the items to be copied
     :param table: The table name that items will be copied into
     :param d_dst: A DynamoDB client of the destination
     :param page: A specified page number to copied.
+    :param partition_key: If set, every put is conditional on no item with the same key existing, and items that
+    already exist are left untouched.
+    :param executor: The pool that the transactions are written on. If None they are written one by one.
+    :param limiter: A TokenBucket of write capacity units that every transaction is paid from. If None transactions
+    are not limited.
     :return:
     """
 
-    list_of_items = []
-    records_batch = []
+    # Every item is sized once, for both the transaction size limit and the write limiter.
+    sized_items = ((item, _item_size(item)) for item in items_to_write)
+    transactions = chunked_by_size(sized_items, TRANSACTION_SIZE, TRANSACTION_BYTES, lambda sized_item: sized_item[1])
 
-    if items_to_write:
-        for item in items_to_write:
-            record = {'PutRequest': {'Item': item}}
-            records_batch.append(record)
+    with _table_pool(executor) as executor:
+        written = sum(executor.map(lambda transaction: write_transaction(d_dst, table, *zip(*transaction),
+                                                                         partition_key=partition_key,
+                                                                         limiter=limiter),
+                                   transactions))
+
+    if partition_key:
+        log.info(f'Page {page} for Table {table}: {written} items copied, '
+                 f'{len(items_to_write) - written} already existed')
+    else:
+        log.info(f'Page {page} for Table {table}: {written} items copied')
 
-            if len(records_batch) == 25:
-                list_of_items.append(records_batch)
-                records_batch = []
 
-        list_of_items.append(records_batch)
+def write_transaction(dst: client, table: str, items: list, sizes: list = None, partition_key: str = None,
+                      limiter: 'TokenBucket' = None) -> int:
+    """
+    Writes items in a single transaction. When conditional puts cancel the transaction because some of the items
+    already exist, the transaction is retried without them. Transactions cancelled by throttling or conflicting
+    writes are retried with an exponential backoff.
+    :param dst: A DynamoDB client of the destination
+    :param table: The table name that items will be copied into
+    :param items: The items to be written, at most 100
+    :param sizes: The sizes of the items in bytes, if they are already known
+    :param partition_key: If set, every put is conditional on no item with the same key existing
+    :param limiter: A TokenBucket of write capacity units that every request is paid from. If None requests are not
+    limited.
+    :return: The number of items written
+    """
 
-        total_number_of_batches = len(list_of_items)
-        count = 1
+    if limiter and sizes is None:
+        sizes = [_item_size(item) for item in items]
 
-        for batch in list_of_items:
+    # Only retries of throttled or conflicting transactions count towards MAX_WRITE_ATTEMPTS. Retries without the
+    # existing items always make progress, since at least one item is dropped each time.
+    attempt = 0
 
-            if batch:
-                request = {table: batch}
+    while True:
+        if limiter:
+            # Transactional writes consume two write capacity units per KB.
+            limiter.acquire(2 * sum(_size_units(size) for size in sizes))
 
-                try:
-                    r = d_dst.batch_write_item(RequestItems=request)
-                    leftovers = r['UnprocessedItems']
-
-                    while leftovers:
-                        leftovers = write_records(d_dst, leftovers)
-                    sys.stdout.flush()
-                    sys.stdout.write(f'\rPage {page} Batch {count}/{total_number_of_batches} for Table {table} copied '
-                                     f'successfully!')
-                except Exception as e:
-                    sys.stdout.flush()
-                    sys.stdout.write(f'\rPage {page} Batch {count}/{total_number_of_batches} for Table {table} failed '
-                                     f'to copy!: {e}')
+        puts = [{'Put': {'TableName': table, 'Item': item}} for item in items]
+        if partition_key:
+            for put in puts:
+                put['Put']['ConditionExpression'] = 'attribute_not_exists(#pk)'
+                put['Put']['ExpressionAttributeNames'] = {'#pk': partition_key}
 
-            else:
-                print('Batch is empty, skipping')
-            count += 1
-        sys.stdout.write('\n')
-    else:
-        print('Table {} is empty!'.format(table))
+        try:
+            dst.transact_write_items(TransactItems=puts)
+            return len(items)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            failures = set(reasons) - {'None', None}
+            if not failures or not failures <= RETRYABLE_CANCELLATIONS | {'ConditionalCheckFailed'}:
+                raise
+
+            kept = [i for i, reason in enumerate(reasons) if reason != 'ConditionalCheckFailed']
+            items = [items[i] for i in kept]
+            sizes = sizes and [sizes[i] for i in kept]
+            if not items:
+                return 0
+
+            if failures - {'ConditionalCheckFailed'}:
+                attempt += 1
+                if attempt >= MAX_WRITE_ATTEMPTS:
+                    raise RuntimeError(f'Transaction of {len(items)} items for Table {table} was still cancelled '
+                                       f'after {MAX_WRITE_ATTEMPTS} attempts')
+                _backoff(attempt)
+
+
+def write_records(dst: client, records: dict, limiter: 'TokenBucket' = None) -> None:
+    """
+    Writes a batch of records, resubmitting the unprocessed items until all of them are written. Throttled requests
+    are retried by the adaptive retry mode of the client, but partially throttled batches succeed and only report
+    their UnprocessedItems, so those are resubmitted with an exponential backoff of their own for as long as the
+    attempts make progress.
+    :param dst: A DynamoDB client of the destination
+    :param records: The RequestItems of a batch_write_item request
+    :param limiter: A TokenBucket of write capacity units that every request is paid from. If None requests are not
+    limited.
+    :return: None
+    """
+
+    if limiter:
+        # The items are sized once. UnprocessedItems come back as new objects, so resubmissions are paid by the
+        # average size of the batch.
+        requests = [request for table_requests in records.values() for request in table_requests]
+        average_units = sum(_write_units(request['PutRequest']['Item']) for request in requests) / len(requests)
 
+    # Only attempts that write nothing count towards MAX_WRITE_ATTEMPTS, a batch that keeps shrinking is never given up.
+    unprocessed = sum(len(table_requests) for table_requests in records.values())
+    attempt = stalled = 0
 
-@backoff.on_predicate(backoff.expo(), lambda leftovers: len(leftovers) > 0, jitter=backoff.full_jitter)
-def write_records(dst, records):
-    r = dst.batch_write_item(RequestItems=records)
-    return r['UnprocessedItems']
+    while True:
+        if attempt:
+            _backoff(attempt)
+        if limiter:
+            limiter.acquire(average_units * unprocessed)
 
+        records = dst.batch_write_item(RequestItems=records)['UnprocessedItems']
+        if not records:
+            return
 
-def get_total_items(table: str, aws_session: Session) -> list:
+        remaining = sum(len(table_requests) for table_requests in records.values())
+        stalled = stalled + 1 if remaining == unprocessed else 0
+        if stalled >= MAX_WRITE_ATTEMPTS:
+            raise RuntimeError(f'{remaining} items were still unprocessed after {MAX_WRITE_ATTEMPTS} attempts '
+                               f'that wrote nothing')
+
+        unprocessed = remaining
+        attempt += 1
+
+
+def _backoff(attempt: int) -> None:
+    # Exponential backoff with full jitter.
+    # The exponent is capped so that long running retries never overflow the float.
+    time.sleep(random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** min(attempt, 32))))
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket that limits the write capacity units spent on a table per second. The bucket holds at
+    most one second worth of tokens, callers that take more tokens than available sleep until the debt is refilled.
     """
-    A helper function to get programmatically all items from a table and
+
+    def __init__(self, rate: float):
+        """
+        :param rate: The number of tokens added to the bucket every second
+        """
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float) -> None:
+        """
+        Takes tokens from the bucket, blocking until they are paid for.
+        :param tokens: The number of tokens to be taken
+        :return: None
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - tokens
+            self.updated = now
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_write_limiter(description: dict) -> 'TokenBucket':
+    """
+    Creates a TokenBucket that limits the writes to a table to a share of its provisioned write capacity.
+    :param description: The table description as returned by describe_table
+    :return: A TokenBucket, or None for on-demand tables that have no provisioned capacity
+    """
+
+    write_capacity = description.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+    if not write_capacity:
+        return None
+    return TokenBucket(write_capacity * WRITE_CAPACITY_SHARE)
+
+
+def _write_units(item: dict) -> int:
+    return _size_units(_item_size(item))
+
+
+def _size_units(size: int) -> int:
+    # A write consumes one WCU for every started KB of the item.
+    return max(1, math.ceil(size / 1024))
+
+
+def _item_size(item: dict) -> int:
+    return sum(len(name.encode()) + _attribute_size(value) for name, value in item.items())
+
+
+def _attribute_size(value: dict) -> int:
+    # An approximation of the DynamoDB item size rules, see "Item sizes and formats" in the DynamoDB developer guide.
+    (kind, data), = value.items()
+
+    if kind == 'S':
+        return len(data.encode())
+    if kind == 'N':
+        return len(data) // 2 + 1
+    if kind == 'B':
+        return len(data)
+    if kind == 'SS':
+        return sum(len(element.encode()) for element in data)
+    if kind == 'NS':
+        return sum(len(element) // 2 + 1 for element in data)
+    if kind == 'BS':
+        return sum(len(element) for element in data)
+    if kind == 'M':
+        return 3 + sum(len(name.encode()) + _attribute_size(element) + 1 for name, element in data.items())
+    if kind == 'L':
+        return 3 + sum(_attribute_size(element) + 1 for element in data)
+    # BOOL and NULL
+    return 1
+
+
+def iter_total_items(table: str, aws_session: Session):
+    """
+    A generator that yields all items of a table page by page, without keeping the whole table in memory.
     :param table: The table name to retrieve its items
     :param aws_session: The AWS Session of the targeted AWS profile/region
+    :return: A generator of items
+    """
+
+    for response in scan_segment(table, _client(aws_session)):
+        yield from response['Items']
+
+
+def get_total_items(table: str, aws_session: Session, total_segments: int = None, workers: int = 16) -> list:
+    """
+    A helper function to get programmatically all items from a table. The table is scanned in parallel segments.
+    Prefer iter_total_items when the items can be processed one by one.
+    :param table: The table name to retrieve its items
+    :param aws_session: The AWS Session of the targeted AWS profile/region
+    :param total_segments: The number of segments the table is split into. If None one segment per MB is used.
+    :param workers: The maximum number of segments that are scanned concurrently.
     :return: A list that contains all items
     """
-    d_client = aws_session.client('dynamodb')
-    print(f"Scanning table {table} in {aws_session.region_name}")
+
+    d_client = _client(aws_session)
+    log.info(f"Scanning table {table} in {aws_session.region_name}")
 
     try:
-        response = d_client.scan(TableName=table)
-    except ClientError:
-        print(f"{table} was not found in {aws_session.region_name}")
+        description = _describe_table(aws_session, table)
+    except ClientError as e:
+        if not _is_not_found(e):
+            raise
+        log.warning(f"{table} was not found in {aws_session.region_name}")
         return []
-    items = response['Items']
-    total_items = items
 
-    while 'LastEvaluatedKey' in response:
-        key = response['LastEvaluatedKey']
-        src_response = d_client.scan(TableName=table, ExclusiveStartKey=key)
-        total_items.extend(src_response['Items'])
+    if total_segments is None:
+        total_segments = get_total_segments(description)
+
+    with ThreadPoolExecutor(max_workers=min(workers, total_segments)) as executor:
+        futures = [executor.submit(_scan_segment_items, table, d_client, segment, total_segments)
+                   for segment in range(total_segments)]
+        total_items = list(chain.from_iterable(future.result() for future in futures))
 
-    print(f"Scanned table {table} in {aws_session.region_name}!")
+    log.info(f"Scanned table {table} in {aws_session.region_name}!")
 
     return total_items
+
+
+def _scan_segment_items(table: str, d_client: client, segment: int, total_segments: int) -> list:
+    return [item for response in scan_segment(table, d_client, segment, total_segments) for item in response['Items']]